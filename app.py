@@ -1,12 +1,129 @@
 # app.py
+import os
+import sqlite3
+import threading
+import uuid
+import orjson
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import caddy
 import socat
+from db import get_db_connection
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes responses and parses request bodies with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Match routes with or without a trailing slash from a single rule each
+app.url_map.strict_slashes = False
+
+# Create the database tables once at startup, whichever server imports us
+caddy.init_db()
+socat.init_db()
+# gunicorn loads the app on the worker's main thread, after it has reset
+# the worker's signal handlers
+socat.install_reaper()
+
+# Listing tags from an earlier process must never match, whatever its
+# generation count reached, so every tag carries a per-boot token
+_BOOT_TOKEN = uuid.uuid4().hex[:12]
+
+# Bumped after every write request so polled listings can answer 304.
+# This is per process, which matches the single gunicorn worker.
+_generation = 0
+_generation_lock = threading.Lock()
+
+# Last PRAGMA data_version seen by each thread's connection, to notice
+# commits made outside this worker (sqlite3 shell, scripts, ...)
+_seen = threading.local()
+
+def _bump_generation():
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+# Methods whose requests may write. HEAD and OPTIONS never do.
+WRITE_METHODS = frozenset({'POST', 'PUT', 'PATCH', 'DELETE'})
+
+@app.after_request
+def bump_generation(response):
+    # Regardless of status: a request that fails partway may still have
+    # written, and data_version doesn't see this thread's own commits
+    if request.method in WRITE_METHODS:
+        _bump_generation()
+    return response
+
+def listing_generation():
+    """
+    Return the current generation, first bumping it if this thread's
+    connection sees commits it hasn't seen before. data_version only moves
+    for commits by other connections; this worker's own writes are counted
+    by bump_generation. A thread's first look always bumps, since a write
+    may have landed before it started watching.
+    """
+    version = get_db_connection().execute("PRAGMA data_version").fetchone()[0]
+    if getattr(_seen, "data_version", None) != version:
+        _seen.data_version = version
+        _bump_generation()
+    return f"{_BOOT_TOKEN}-{_generation}"
+
+def conditional_listing(etag, build):
+    """Return 304 if the client already holds `etag`, else build and tag the listing."""
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    return response
+
+def batch_results(results, missing=None):
+    """
+    Make a run_batch() result JSON-friendly, reporting failures as errors.
+    A None result is reported as missing(key) if that is given.
+    """
+    def entry(key, result):
+        if isinstance(result, Exception):
+            return {"error": str(result)}
+        if result is None and missing:
+            return {"error": missing(key)[0]}
+        return result
+    return {key: entry(key, result) for key, result in results.items()}
+
+# Fields a socat relay can't be stored without
+RELAY_FIELDS = ("listening_port", "target_host", "target_port")
+
+def missing_relay_fields(data):
+    """Return the required relay fields that are absent or null in a request body."""
+    return [field for field in RELAY_FIELDS if data.get(field) is None]
+
+def relay_integrity_error(e, data):
+    """
+    Map a relay write's IntegrityError to a response: 409 when another relay
+    already has the listening port, 400 for any other constraint.
+    """
+    if "UNIQUE constraint failed: socat_relays.listening_port" in str(e):
+        return jsonify(error=f"A relay already listens on port {data['listening_port']}."), 409
+    return jsonify(error=str(e)), 400
+
+def caddy_action_failure(server_name):
+    """Return the error and status for a start/stop that gave back no row."""
+    if not caddy.db_get_caddy_server(server_name):
+        return f"No Caddy server named '{server_name}'.", 404
+    return f"Caddy rejected the configuration for '{server_name}'.", 502
 
 @app.route('/caddy/config', methods=['GET'])
-@app.route('/caddy/config/', methods=['GET'])
 def get_caddy_config():
     try:
         return jsonify(caddy.get_caddy_config()), 200
@@ -14,15 +131,13 @@ def get_caddy_config():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/servers', methods=['GET'])
-@app.route('/caddy/servers/', methods=['GET'])
 def get_caddy_servers():
     try:
-        return jsonify(caddy.db_list_caddy_servers()), 200
+        return conditional_listing(f"caddy-{listing_generation()}", caddy.db_list_caddy_servers)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/servers', methods=['POST'])
-@app.route('/caddy/servers/', methods=['POST'])
 def post_caddy_servers():
     try:
         data = request.get_json()
@@ -33,9 +148,8 @@ def post_caddy_servers():
             tls_trust_pool=data.get("tls_trust_pool"),
             trusted_proxies=data.get("trusted_proxies"),
         )
-        response = caddy.create_caddy_server(server)
-        if response:
-            server_db_entry = caddy.db_get_caddy_server(server.name)
+        server_db_entry = caddy.create_caddy_server(server)
+        if server_db_entry:
             return jsonify(server_db_entry), 201
         else:
             return jsonify(error="Unable to configure Caddy server or add it to db."), 400
@@ -43,7 +157,6 @@ def post_caddy_servers():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/servers/<server_name>', methods=['GET'])
-@app.route('/caddy/servers/<server_name>/', methods=['GET'])
 def get_caddy_servers_specific(server_name):
     try:
         return jsonify(caddy.db_get_caddy_server(server_name)), 200
@@ -51,9 +164,12 @@ def get_caddy_servers_specific(server_name):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/servers/<server_name>', methods=['PUT'])
-@app.route('/caddy/servers/<server_name>/', methods=['PUT'])
 def put_caddy_servers_specific(server_name):
     try:
+        # Check before touching Caddy, so an unknown name can't leave a
+        # server block behind that has no database row
+        if not caddy.db_get_caddy_server(server_name):
+            return jsonify(error=f"No Caddy server named '{server_name}'."), 404
         data = request.get_json()
         server = caddy.CaddyServer(
             hostname=data["hostname"],
@@ -61,47 +177,63 @@ def put_caddy_servers_specific(server_name):
             upstream_url=data["upstream_url"],
             tls_trust_pool=data.get("tls_trust_pool"),
             trusted_proxies=data.get("trusted_proxies"),
+            name=server_name,
         )
         return jsonify(caddy.update_caddy_server(server)), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/actions/start', methods=['POST'])
-@app.route('/caddy/actions/start/', methods=['POST'])
 def post_caddy_actions_start():
     try:
         data = request.get_json()
+        if 'names' in data:
+            # Several servers at once, handled concurrently
+            results = caddy.start_caddy_servers(data['names'])
+            return jsonify(batch_results(results, missing=caddy_action_failure)), 200
         server_name = data['name']
-        response = caddy.start_caddy_server(server_name)
-        if response.status_code == 200:
-            return jsonify(caddy.db_get_caddy_server(server_name)), 200
+        server_db_entry = caddy.start_caddy_server(server_name)
+        if server_db_entry:
+            return jsonify(server_db_entry), 200
+        error, status = caddy_action_failure(server_name)
+        return jsonify(error=error), status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/caddy/actions/stop', methods=['POST'])
-@app.route('/caddy/actions/stop/', methods=['POST'])
 def post_caddy_actions_stop():
     try:
         data = request.get_json()
+        if 'names' in data:
+            # Several servers at once, handled concurrently
+            results = caddy.stop_caddy_servers(data['names'])
+            return jsonify(batch_results(results, missing=caddy_action_failure)), 200
         server_name = data['name']
-        if caddy.stop_caddy_server(server_name):
-            return jsonify(caddy.db_get_caddy_server(server_name)), 200
+        server_db_entry = caddy.stop_caddy_server(server_name)
+        if server_db_entry:
+            return jsonify(server_db_entry), 200
+        error, status = caddy_action_failure(server_name)
+        return jsonify(error=error), status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 @app.route('/socat/relays', methods=['GET'])
-@app.route('/socat/relays/', methods=['GET'])
 def get_socat_relays():
     try:
-        return jsonify(socat.db_list_socat_relays()), 200
+        # Relays can die on their own, so the live process map is part of the tag
+        running = socat.get_socat_processes()
+        etag = f"socat-{listing_generation()}-{hash(frozenset(running.items()))}"
+        return conditional_listing(etag, lambda: socat.list_socat_relays(running))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/socat/relays', methods=['POST'])
-@app.route('/socat/relays/', methods=['POST'])
 def post_socat_relays():
     try:
         data = request.get_json()
+        missing = missing_relay_fields(data)
+        if missing:
+            return jsonify(error=f"Missing required fields: {', '.join(missing)}."), 400
         relay = socat.SocatRelay(
             listening_port=data["listening_port"],
             target_host=data["target_host"],
@@ -109,15 +241,16 @@ def post_socat_relays():
             timeout=data.get("timeout"),
         )
         if relay.status:
-            relay_db_entry = socat.db_insert_socat_relay(relay)
-            return jsonify(socat.db_get_socat_relay(relay_db_entry)), 201
+            return jsonify(socat.db_insert_socat_relay(relay)), 201
         else:
             return jsonify(error="Unable to configure Caddy server or add it to db."), 400
+    except sqlite3.IntegrityError as e:
+        # listening_port is UNIQUE, so the insert itself is the duplicate check
+        return relay_integrity_error(e, data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/socat/relays/<int:id>', methods=['GET'])
-@app.route('/socat/relays/<int:id>/', methods=['GET'])
 def get_socat_relays_by_id(id):
     try:
         return jsonify(socat.db_get_socat_relay(id)), 200
@@ -125,10 +258,12 @@ def get_socat_relays_by_id(id):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/socat/relays/<int:id>', methods=['PUT'])
-@app.route('/socat/relays/<int:id>/', methods=['PUT'])
 def put_socat_relays_by_id(id):
     try:
         data = request.get_json()
+        missing = missing_relay_fields(data)
+        if missing:
+            return jsonify(error=f"Missing required fields: {', '.join(missing)}."), 400
         relay = socat.SocatRelay(
             listening_port=data["listening_port"],
             target_host=data["target_host"],
@@ -136,38 +271,56 @@ def put_socat_relays_by_id(id):
             timeout=data.get("timeout"),
         )
         if relay.status:
-            socat.db_update_socat_relay(relay, id)
-            return jsonify(socat.db_get_socat_relay(id)), 201
+            return jsonify(socat.db_update_socat_relay(relay, id)), 201
         else:
             return jsonify(error="Unable to configure Caddy server or add it to db."), 400
+    except sqlite3.IntegrityError as e:
+        # listening_port is UNIQUE, so the update is rejected if another relay has the port
+        return relay_integrity_error(e, data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/socat/actions/start', methods=['POST'])
-@app.route('/socat/actions/start/', methods=['POST'])
 def post_socat_actions_start():
     try:
         data = request.get_json()
+        if 'ids' in data:
+            # Several relays at once, spawned back to back
+            relays = [socat.socat_relay_from_db(relay_id) for relay_id in data['ids']]
+            processes = socat.start_socat_relays(relays)
+            return jsonify({
+                relay_id: socat.db_update_socat_relay_status(relay_id, 'running', process.pid)
+                if process.poll() is None else {"error": "socat exited right after starting"}
+                for relay_id, process in zip(data['ids'], processes)
+            }), 200
         relay_id = data['id']
         relay = socat.socat_relay_from_db(relay_id)
-        relay.start()
-        if relay.status == 'running':
-            socat.db_update_socat_relay(relay, relay_id)
-            return jsonify(socat.db_get_socat_relay(relay_id)), 200
+        process = relay.start()
+        if process.poll() is None:
+            return jsonify(socat.db_update_socat_relay_status(relay_id, 'running', process.pid)), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/socat/actions/stop', methods=['POST'])
-@app.route('/socat/actions/stop/', methods=['POST'])
 def post_socat_actions_stop():
     try:
         data = request.get_json()
+        if 'ids' in data:
+            # Several relays at once, their grace periods overlapping
+            relays = {relay_id: socat.socat_relay_from_db(relay_id) for relay_id in data['ids']}
+            stopped = socat.stop_socat_relays(list(relays.values()))
+            results = {}
+            for relay_id, relay in relays.items():
+                result = stopped[relay.listening_port]
+                if not isinstance(result, Exception):
+                    result = socat.db_update_socat_relay_status(relay_id, 'stopped')
+                results[relay_id] = result
+            return jsonify(batch_results(results)), 200
         relay_id = data['id']
         relay = socat.socat_relay_from_db(relay_id)
         relay.stop()
         if relay.status == 'stopped':
-            socat.db_update_socat_relay(relay, relay_id)
-            return jsonify(socat.db_get_socat_relay(relay_id)), 200
+            return jsonify(socat.db_update_socat_relay_status(relay_id, 'stopped')), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -181,8 +334,6 @@ def post_socat_actions_stop():
 #     return jsonify({"status": "healthy"}), 200
 
 if __name__ == '__main__':
-    # Initialize databases
-    caddy.init_db()
-    
-    # Start the Flask app
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Start the Flask dev server; production runs under gunicorn (see gunicorn.conf.py).
+    # Set DEBUG=1 for the reloader and interactive debugger.
+    app.run(host='0.0.0.0', port=5000, debug=bool(os.environ.get('DEBUG')))
\ No newline at end of file
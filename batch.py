@@ -0,0 +1,35 @@
+"""
+batch.py
+Run one blocking action over several items on a small thread pool.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+# Batched actions mostly wait on the Caddy admin API or on processes
+# exiting, so threads overlap well. Keep this at or below the requests
+# session's pool_maxsize so every worker gets a pooled connection.
+BATCH_WORKERS = 8
+
+def run_batch(action: Callable, items: Iterable, key: Callable = lambda item: item) -> Dict[Any, Any]:
+    """
+    Call `action(item)` for every item concurrently.
+
+    A failure for one item doesn't stop the others: its exception is
+    returned in place of the result.
+
+    Returns:
+        dict: key(item) mapped to what `action` returned, or the exception it raised.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        futures = {key(item): pool.submit(action, item) for item in items}
+        for item_key, future in futures.items():
+            try:
+                results[item_key] = future.result()
+            except Exception as e:
+                logger.error("%s failed for %r: %s", action.__name__, item_key, e)
+                results[item_key] = e
+    return results
@@ -4,16 +4,25 @@ caddy.py
 A tiny interactive tool to create Caddy reverse‑proxy
 configurations via the Caddy admin API.
 """
+import copy
 import json
 import logging
+import orjson
 import os
 import requests
 import sqlite3
 import sys
 import re
-from dataclasses import dataclass, field
-from pathlib import Path
-from typing import List, Optional, Dict
+import threading
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from requests.adapters import HTTPAdapter
+from typing import List, Optional, Dict, Tuple, Union
+from urllib3.util.retry import Retry
+
+from batch import run_batch
+from db import get_db_connection
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,9 +31,73 @@ logger = logging.getLogger(__name__)
 # Default Caddy admin API URL
 ADMIN_URL = os.getenv("CADDY_ADMIN_URL", "http://localhost:2019")
 
-# Database file path
-default_db_path = Path.home() / ".tailrelay.db"
-DB_PATH = os.getenv("DB_PATH", default_db_path)
+# Port in a server's listen address (":8080", "0.0.0.0:8080", ...)
+_LISTEN_PORT_RE = re.compile(r":(\d+)")
+
+def _build_session() -> requests.Session:
+    """
+    Build the session shared by all admin API calls.
+
+    Connections to the admin endpoint are pooled and kept alive, and
+    transient failures (refused connections, 502/503/504) on GET and DELETE
+    are retried with a short backoff. PUT is left out: Caddy's PUT on a
+    config path is create-only, so a replay of one that already applied
+    would come back 409.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"GET", "DELETE"}),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_SESSION = _build_session()
+
+# How long a fetched Caddy config is reused before asking the admin API again.
+# Everything that changes the config through this module clears it.
+CONFIG_CACHE_TTL = 2.0
+_config_cache: Dict[str, Tuple[float, Dict]] = {}
+# Bumped by every clear, so a fetch that was already in flight when Caddy
+# changed doesn't put the old config back
+_config_generation = 0
+_config_lock = threading.Lock()
+# One GET /config at a time; threads that miss the cache together wait for
+# the first one's result instead of each fetching
+_config_fetch_lock = threading.Lock()
+
+def clear_config_cache() -> None:
+    """Forget every cached Caddy config."""
+    global _config_generation
+    with _config_lock:
+        _config_generation += 1
+        _config_cache.clear()
+
+def _cached_config(caddy_admin_url: str) -> Optional[Tuple[float, Dict]]:
+    """Return the (fetch time, config) entry for a URL if it is still fresh."""
+    with _config_lock:
+        cached = _config_cache.get(caddy_admin_url)
+    if cached and time.monotonic() - cached[0] < CONFIG_CACHE_TTL:
+        return cached
+    return None
+
+def _check_response(response: requests.Response) -> requests.Response:
+    """
+    Raise for an error status on a `stream=True` response, otherwise
+    consume its (empty) body so the connection goes back to the pool.
+
+    Error bodies are never read; the connection is closed instead, which
+    is cheaper than buffering a Caddy error dump nobody looks at.
+    """
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    _ = response.content  # drain the empty body so the connection returns to the pool
+    return response
 
 @dataclass
 class CaddyServer:
@@ -35,17 +108,18 @@ class CaddyServer:
     upstream_url: str
     tls_trust_pool: Optional[str] = None
     trusted_proxies: Optional[List[str]] = None
-    server_config: Dict[str, Dict] = field(init=False)
-
-    # Flag to prevent rebuild during initialization
-    _initialized: bool = field(default=False, init=False, repr=False)
+    # Servers loaded from the database or Caddy pass their existing name
+    name: Optional[str] = None
     
     def __post_init__(self) -> None:
-        if not self._initialized:
+        if self.name is None:
             server_hash = str(abs(hash((self.hostname, self.port))))[:8]
             self.name = f'srv{server_hash}'
-        self.server_config = self._build_config()
-        self._initialized = True
+
+    @cached_property
+    def server_config(self) -> Dict[str, Dict]:
+        """The server block keyed by name, built on first access."""
+        return self._build_config()
 
     def _build_config(self) -> Dict[str, Dict]:
         """Return a dictionary mapping a unique server name to its block."""
@@ -53,51 +127,45 @@ class CaddyServer:
             "handler": "reverse_proxy",
             "headers": {
                 "request": {
-                    "set": {
-                        "Host": [
-                            "{http.reverse_proxy.upstream.hostport}"
-                        ],
-                    },
+                    "set": {"Host": ["{http.reverse_proxy.upstream.hostport}"]},
                 },
             },
             "upstreams": [{"dial": self.upstream_url}],
         }
-        
         if self.tls_trust_pool:
             reverse_proxy["transport"] = {
                 "protocol": "http",
                 "tls": {
-                    "ca": {
-                        "pem_files": [self.tls_trust_pool],
-                        "provider": "file",
-                    },
+                    "ca": {"pem_files": [self.tls_trust_pool], "provider": "file"},
                 },
             }
-
         if self.trusted_proxies:
             reverse_proxy["trusted_proxies"] = self.trusted_proxies
 
-        subroute = {
-            "handler": "subroute",
-            "routes": [{"handle": [reverse_proxy]}],
-        }
-
-        route = {
-            "match": [{"host": [self.hostname]}],
-            "handle": [subroute],
-            "terminal": True,
-        }
-
-        server = {
-            "listen": [f":{self.port}"],
-            "routes": [route],
+        # The rest of the block is fixed, so build it in one literal
+        return {
+            self.name: {
+                "listen": [f":{self.port}"],
+                "routes": [
+                    {
+                        "match": [{"host": [self.hostname]}],
+                        "handle": [
+                            {"handler": "subroute", "routes": [{"handle": [reverse_proxy]}]},
+                        ],
+                        "terminal": True,
+                    },
+                ],
+            },
         }
 
-        return {self.name: server}
-
     @property
     def status(self):
-        return 'running' if get_caddy_server(self.name) else 'stopped'
+        # A status set by start/stop records what they just did to Caddy;
+        # only ask Caddy when nothing has been set
+        known = self.__dict__.get("_status")
+        if known is not None:
+            return known
+        return 'running' if self.name in get_running_caddy_servers() else 'stopped'
 
     @status.setter
     def status(self, value):
@@ -105,14 +173,13 @@ class CaddyServer:
         # Perform validation or transformation here
         if value not in ['stopped', 'running']:
             raise ValueError("Status can only be set to 'stopped' or 'running'")
-        self._attribute = value
+        self._status = value
 
     def __setattr__(self, name: str, value: object) -> None:
         super().__setattr__(name, value)
-        if not getattr(self, "_initialized", False):
-            return
         if name in {"name", "hostname", "port", "upstream_url", "tls_trust_pool", "trusted_proxies"}:
-            self.server_config = self._build_config()
+            # Drop the cached block so the next read rebuilds it
+            self.__dict__.pop("server_config", None)
 
 def get_caddy_config(caddy_admin_url:str = ADMIN_URL) -> bool:
     """
@@ -124,51 +191,71 @@ def get_caddy_config(caddy_admin_url:str = ADMIN_URL) -> bool:
         
     Returns:
         dict: The current Caddy configuration as a Python dictionary.
+        The result is cached for CONFIG_CACHE_TTL seconds and must not be mutated.
         
     Raises:
         requests.exceptions.RequestException: If the HTTP request fails.
         json.JSONDecodeError: If the response is not valid JSON.
     """
-    try:
-        response = requests.get(f"{caddy_admin_url}/config")
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching Caddy config: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON response: {e}")
-        raise
-
-def get_caddy_server(server_name:str, caddy_admin_url:str = ADMIN_URL) -> bool:
+    cached = _cached_config(caddy_admin_url)
+    if cached:
+        return cached[1]
+    with _config_fetch_lock:
+        # Another thread may have fetched it while this one waited
+        cached = _cached_config(caddy_admin_url)
+        if cached:
+            return cached[1]
+        with _config_lock:
+            generation = _config_generation
+        try:
+            response = _SESSION.get(f"{caddy_admin_url}/config")
+            response.raise_for_status()  # Raises an HTTPError for bad responses
+            # orjson parses the raw bytes directly; its JSONDecodeError
+            # subclasses json.JSONDecodeError, so the handler below still applies
+            config = orjson.loads(response.content)
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching Caddy config: {e}")
+            raise
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON response: {e}")
+            raise
+        with _config_lock:
+            # Caddy changed while the request was in flight, so this config
+            # may predate it; hand it back but don't keep it
+            if _config_generation == generation:
+                _config_cache[caddy_admin_url] = (time.monotonic(), config)
+        return config
+
+def get_caddy_server(server_name:str, caddy_admin_url:str = ADMIN_URL) -> Optional[Dict]:
     """
-    Fetches the current configuration from Caddy's admin API.
+    Looks up a server in the (cached) Caddy configuration.
     
     Args:
-        server_name (str): the name of the sever in the Caddy config
+        server_name (str): the name of the sever in the Caddy config, or "ALL"
         caddy_admin_url (str): The base URL of the Caddy admin API. Defaults to http://localhost:2019.
         
     Returns:
-        dict: The current Caddy configuration as a Python dictionary.
+        dict: The server's configuration, None if Caddy has no such server,
+        or every server keyed by name when server_name is "ALL".
         
     Raises:
         requests.exceptions.RequestException: If the HTTP request fails.
         json.JSONDecodeError: If the response is not valid JSON.
     """
-    try:
-        if server_name == "ALL":
-            url = f"{caddy_admin_url}/config/apps/http/servers/"
-        else:
-            url = f"{caddy_admin_url}/config/apps/http/servers/{server_name}"
-        response = requests.get(url)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching Caddy config: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON response: {e}")
-        raise
+    config = get_caddy_config(caddy_admin_url) or {}
+    servers = ((config.get("apps") or {}).get("http") or {}).get("servers") or {}
+    if server_name == "ALL":
+        return servers
+    return servers.get(server_name)
+
+def get_running_caddy_servers(caddy_admin_url:str = ADMIN_URL) -> set:
+    """
+    Returns the names of every server in the (cached) Caddy configuration.
+
+    One fetch of the servers map answers the running/stopped question for
+    any number of servers.
+    """
+    return set(get_caddy_server("ALL", caddy_admin_url))
 
 def delete_caddy_server(server_name:str, stop_server:bool = False, caddy_admin_url:str = ADMIN_URL) -> bool:
     """
@@ -186,9 +273,9 @@ def delete_caddy_server(server_name:str, stop_server:bool = False, caddy_admin_u
         json.JSONDecodeError: If the response is not valid JSON.
     """
     try:
-        response = requests.delete(f"{caddy_admin_url}/config/apps/http/servers/{server_name}")
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response
+        response = _SESSION.delete(f"{caddy_admin_url}/config/apps/http/servers/{server_name}", stream=True)
+        clear_config_cache()
+        return _check_response(response)  # Raises an HTTPError for bad responses
     except requests.exceptions.RequestException as e:
         print(f"Error fetching Caddy config: {e}")
         raise
@@ -196,46 +283,48 @@ def delete_caddy_server(server_name:str, stop_server:bool = False, caddy_admin_u
         print(f"Error decoding JSON response: {e}")
         raise
 
-def create_caddy_server(caddy_server:CaddyServer, start_server:bool = False, caddy_admin_url:str = ADMIN_URL) -> bool:
+def _load_http_scaffold(caddy_admin_url:str = ADMIN_URL) -> None:
+    """
+    Load a config that has an empty apps.http.servers map, keeping whatever
+    else Caddy is already running. Callers clear the config cache first.
     """
-    Send the configuration to Caddy's admin API.
+    config = copy.deepcopy(get_caddy_config(caddy_admin_url)) or {}
+    config.setdefault("apps", {}).setdefault("http", {}).setdefault("servers", {})
+    response = _SESSION.post(
+        f"{caddy_admin_url}/load",
+        headers={"Content-Type": "application/json"},
+        data=orjson.dumps(config),
+    )
+    clear_config_cache()
+    response.raise_for_status()
+
+def push_caddy_server(caddy_server:CaddyServer, caddy_admin_url:str = ADMIN_URL) -> bool:
+    """
+    Send a server's block to Caddy's admin API.
+
+    Returns True if Caddy accepted it, False (after logging why) if not.
     """
     try:
-        # Get current config to check if it's empty
-        current_config = get_caddy_config()
-        
-        # If config is empty or None, push a blank initial config first
-        if not current_config or not current_config.get("apps", {}).get("http", {}).get("servers"):
-            current_config = {
-                "apps": {
-                    "http": {
-                        "servers": {}
-                    }
-                }
-            }
-            
-        # Push the new server to existing config using path traversal
+        # Only the new server block goes over the wire, not the whole config
         logger.info("Adding new server to existing configuration...")
-        
-        # Get the current full config
-        full_config = current_config
-        
-        # Extract the server data from the config parameter
-        for server_name, server_data in caddy_server.server_config.items():
-            full_config["apps"]["http"]["servers"][server_name] = server_data
-        
-        # Push the updated config back to Caddy
-        url = f"{caddy_admin_url}/load"
+        url = f"{caddy_admin_url}/config/apps/http/servers/{caddy_server.name}"
+        data = orjson.dumps(caddy_server.server_config[caddy_server.name])
         headers = {"Content-Type": "application/json"}
-        response = requests.post(url, headers=headers, data=json.dumps(full_config))
+        response = _SESSION.put(url, headers=headers, data=data)
+        clear_config_cache()
+
+        # A freshly booted Caddy has no apps.http.servers to add to yet, so
+        # load that scaffold once (keeping any other apps) and try again
+        if response.status_code in (400, 404) and get_caddy_server("ALL", caddy_admin_url) == {}:
+            logger.info("Caddy has no http servers yet, loading an initial config...")
+            _load_http_scaffold(caddy_admin_url)
+            response = _SESSION.put(url, headers=headers, data=data)
+            clear_config_cache()
         if response.status_code != 200:
             logger.error(f"Caddy returned {response.status_code}: {response.text}")
             return False
         logger.info("Configuration applied successfully!")
-
-        if not start_server:
-            db_insert_caddy_server(caddy_server)
-        return response
+        return True
     except requests.exceptions.RequestException as e:
         logger.error(f"Error pushing config: {e}")
         return False
@@ -243,17 +332,30 @@ def create_caddy_server(caddy_server:CaddyServer, start_server:bool = False, cad
         logger.error(f"Unexpected error in push_config: {e}")
         return False
 
-def update_caddy_server(caddy_server:CaddyServer, caddy_admin_url:str = ADMIN_URL) -> bool:
+def create_caddy_server(caddy_server:CaddyServer, caddy_admin_url:str = ADMIN_URL) -> Optional[Dict]:
+    """
+    Add a new server to Caddy and record it in the database.
+
+    Returns the new database row, or None if Caddy rejected the server.
+    """
+    if not push_caddy_server(caddy_server, caddy_admin_url):
+        return None
+    return db_insert_caddy_server(caddy_server)
+
+def update_caddy_server(caddy_server:CaddyServer, caddy_admin_url:str = ADMIN_URL) -> Optional[Dict]:
+    """
+    Replace a server's block in Caddy and return its updated database row.
+    """
     try:
         url = f"{caddy_admin_url}/config/apps/http/servers/{caddy_server.name}/"
         data = caddy_server.server_config[caddy_server.name]
         headers = {"Content-Type": "application/json"}
 
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
+        response = _SESSION.post(url, data=orjson.dumps(data), headers=headers, stream=True)
+        clear_config_cache()
+        _check_response(response)  # Raises an HTTPError for bad responses
         
-        db_update_caddy_server(caddy_server)
-        return response
+        return db_update_caddy_server(caddy_server)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching Caddy config: {e}")
         raise
@@ -261,70 +363,75 @@ def update_caddy_server(caddy_server:CaddyServer, caddy_admin_url:str = ADMIN_UR
         print(f"Error decoding JSON response: {e}")
         raise
 
-def start_caddy_server(server_name: str) -> None:
+def start_caddy_server(server_name: str) -> Optional[Dict]:
     """
     Start a Caddy server with the given name.
     
     Args:
         server_name (str): The name of the server to start
+
+    Returns:
+        dict: The server's updated database row, or None if Caddy did not start it.
     """
     try:
-        running_server = get_caddy_server(server_name)
-        if running_server:
+        if server_name in get_running_caddy_servers():
             db_running_server = db_build_caddy_server(server_name)
             db_running_server.status = 'running'
-            db_update_caddy_server(db_running_server)
             logger.info(f"Server '{server_name}' is already running.")
-            return json.dumps(db_running_server)
+            return db_update_caddy_server(db_running_server)
     except Exception as e:
         logger.error(f"Unable to retrieve running servers: {e}")
 
     try:
         server_to_start = db_build_caddy_server(server_name)
-        response = create_caddy_server(server_to_start, start_server=True)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
     except sqlite3.DatabaseError as e:
         logger.error("Unable to build Caddy server from database.")
         raise
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching Caddy config: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON response: {e}")
-        raise
-    
-    if response.status_code == 200:
-        server_to_start.status = 'running'
-        db_update_caddy_server(server_to_start)
-        logger.info(f"Server '{server_name}' loaded from DB into Caddy and started.")
-    
-    return response or None
+    if server_to_start is None:
+        logger.error(f"Server '{server_name}' not found in database.")
+        return None
 
-def stop_caddy_server(server_name: str) -> None:
+    # The row already exists, so only push the block to Caddy
+    if not push_caddy_server(server_to_start):
+        return None
+
+    server_to_start.status = 'running'
+    logger.info(f"Server '{server_name}' loaded from DB into Caddy and started.")
+    return db_update_caddy_server(server_to_start)
+
+def stop_caddy_server(server_name: str) -> Optional[Dict]:
     """
     Stop a Caddy server with the given name.
     
     Args:
         server_name (str): The name of the server to stop
+
+    Returns:
+        dict: The server's updated database row, or None if neither Caddy
+        nor the database knows the server.
     """
     try:
-        running_server = get_caddy_server(server_name)
-        if not running_server:
+        if server_name not in get_running_caddy_servers():
             logger.info(f"Server '{server_name}' is already stopped.")
-            return
+            db_stopped_server = db_build_caddy_server(server_name)
+            if db_stopped_server is None:
+                return None
+            db_stopped_server.status = 'stopped'
+            return db_update_caddy_server(db_stopped_server)
     except Exception as e:
         logger.error(f"Unable to retrieve running servers: {e}")
 
     try:
-        if not db_get_caddy_server(server_name):
+        existing = db_get_caddy_server(server_name)
+        if not existing:
             logger.info(f"""
                         Server '{server_name}' not found in database.
                         Loading CaddyServer object from running Caddy config.
                         """)
             server_to_stop = load_caddy_server_to_object(server_name)
-            db_server_id = db_insert_caddy_server(server_to_stop)
+            db_server_id = db_insert_caddy_server(server_to_stop)["id"]
         else:
-            db_server_id = db_get_caddy_server(server_name).get('id')
+            db_server_id = existing['id']
             logger.info(f"Server '{server_name}' found in database. Attemping to stop it...")
         if db_server_id:
             response = delete_caddy_server(server_name, stop_server=True)
@@ -341,19 +448,37 @@ def stop_caddy_server(server_name: str) -> None:
     
     server_to_stop = db_build_caddy_server(server_name)
     server_to_stop.status = 'stopped'
-    db_update_caddy_server(server_to_stop)
 
     logger.info(f"Server '{server_name}' stopped.")
     
-    return True
+    return db_update_caddy_server(server_to_stop)
+
+def start_caddy_servers(server_names: List[str]) -> Dict[str, Union[Dict, Exception, None]]:
+    """
+    Start several Caddy servers concurrently.
 
-def init_db(db_path: str = DB_PATH) -> sqlite3.Connection:
+    Returns:
+        dict: Each server name mapped to what start_caddy_server returned,
+        or to the exception it raised.
+    """
+    return run_batch(start_caddy_server, server_names)
+
+def stop_caddy_servers(server_names: List[str]) -> Dict[str, Union[Dict, Exception, None]]:
+    """
+    Stop several Caddy servers concurrently.
+
+    Returns:
+        dict: Each server name mapped to what stop_caddy_server returned,
+        or to the exception it raised.
+    """
+    return run_batch(stop_caddy_server, server_names)
+
+def init_db() -> sqlite3.Connection:
     """
     Initializes the SQLite database and creates the caddy_servers table if it
     does not already exist.
     """
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute(
         """
@@ -365,44 +490,49 @@ def init_db(db_path: str = DB_PATH) -> sqlite3.Connection:
             upstream_url TEXT NOT NULL,
             tls_trust_pool TEXT,
             trusted_proxies TEXT,      -- Stored as JSON string
-            status TEXT DEFAULT stopped,
+            status TEXT DEFAULT 'stopped',
             create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         """
     )
+    # db_list_caddy_servers reads newest first; walk the index instead of sorting
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_caddy_servers_create_time "
+        "ON caddy_servers(create_time DESC)"
+    )
     conn.commit()
     return conn
 
-def get_db_connection():
-    """Create and return a database connection."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def _server_row_to_dict(row: sqlite3.Row) -> Dict:
+    """Convert a caddy_servers row to a dict, decoding trusted_proxies."""
+    trusted_proxies = row["trusted_proxies"]
+    return {**row, "trusted_proxies": orjson.loads(trusted_proxies) if trusted_proxies else None}
 
-def db_insert_caddy_server(server: CaddyServer) -> int:
+def db_insert_caddy_server(server: CaddyServer) -> Dict:
     """
     Inserts a new CaddyServer into the database.
-    Returns the newly created row id.
+    Returns the newly created row as a dictionary.
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO caddy_servers
-        (name, hostname, port, upstream_url, tls_trust_pool, trusted_proxies)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (
-            server.name,
-            server.hostname,
-            server.port,
-            server.upstream_url,
-            server.tls_trust_pool,
-            json.dumps(server.trusted_proxies) if server.trusted_proxies else None,
-        ),
-    )
-    conn.commit()
-    return cursor.lastrowid
+    with conn:
+        row = cursor.execute(
+            """
+            INSERT INTO caddy_servers
+            (name, hostname, port, upstream_url, tls_trust_pool, trusted_proxies)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING *
+            """,
+            (
+                server.name,
+                server.hostname,
+                server.port,
+                server.upstream_url,
+                server.tls_trust_pool,
+                orjson.dumps(server.trusted_proxies).decode() if server.trusted_proxies else None,
+            ),
+        ).fetchone()
+    return _server_row_to_dict(row)
 
 def db_get_caddy_server(name: str) -> Optional[Dict]:
     """
@@ -415,36 +545,37 @@ def db_get_caddy_server(name: str) -> Optional[Dict]:
         "SELECT * FROM caddy_servers WHERE name = ?", (name,)
     )
     row = cursor.fetchone()
-    print(row)
+    logger.debug("caddy_servers row: %r", row)
     if row:
-        server = dict(row)
-        server["trusted_proxies"] = json.loads(server["trusted_proxies"]) if server["trusted_proxies"] else None
-        return server
+        return _server_row_to_dict(row)
     return None
 
-def db_update_caddy_server(server: CaddyServer) -> None:
+def db_update_caddy_server(server: CaddyServer) -> Optional[Dict]:
     """
     Updates an existing server record based on its name.
+    Returns the updated row as a dictionary or None if not found.
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        UPDATE caddy_servers
-        SET hostname = ?, port = ?, upstream_url = ?, tls_trust_pool = ?, trusted_proxies = ?, status = ?
-        WHERE name = ?
-        """,
-        (
-            server.hostname,
-            server.port,
-            server.upstream_url,
-            server.tls_trust_pool,
-            json.dumps(server.trusted_proxies) if server.trusted_proxies else None,
-            server.status,
-            server.name,
-        ),
-    )
-    conn.commit()
+    with conn:
+        row = cursor.execute(
+            """
+            UPDATE caddy_servers
+            SET hostname = ?, port = ?, upstream_url = ?, tls_trust_pool = ?, trusted_proxies = ?, status = ?
+            WHERE name = ?
+            RETURNING *
+            """,
+            (
+                server.hostname,
+                server.port,
+                server.upstream_url,
+                server.tls_trust_pool,
+                orjson.dumps(server.trusted_proxies).decode() if server.trusted_proxies else None,
+                server.status,
+                server.name,
+            ),
+        ).fetchone()
+    return _server_row_to_dict(row) if row else None
 
 def db_delete_caddy_server(name: str) -> None:
     """
@@ -462,13 +593,7 @@ def db_list_caddy_servers() -> List[Dict]:
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM caddy_servers ORDER BY create_time DESC")
-    rows = cursor.fetchall()
-    servers = []
-    for row in rows:
-        server = dict(row)
-        server["trusted_proxies"] = json.loads(server["trusted_proxies"]) if server["trusted_proxies"] else None
-        servers.append(server)
-    return servers
+    return [_server_row_to_dict(row) for row in cursor]
 
 def db_build_caddy_server(name: str) -> Optional[CaddyServer]:
     """
@@ -490,9 +615,8 @@ def db_build_caddy_server(name: str) -> Optional[CaddyServer]:
         upstream_url=record["upstream_url"],
         tls_trust_pool=record.get("tls_trust_pool"),
         trusted_proxies=record.get("trusted_proxies"),
+        name=record["name"],  # Preserve the original database name
     )
-    # Preserve the original database name
-    server.name = record["name"]
     return server
 
 def load_caddy_server_to_object(server_name: str) -> int:
@@ -521,49 +645,38 @@ def load_caddy_server_to_object(server_name: str) -> int:
     # }
 
     # Extract the listening port
-    port: int | None = None
-    if "listen" in server_cfg and server_cfg["listen"]:
-        m = re.search(r":(\d+)", server_cfg["listen"][0])
-        if m:
-            port = int(m.group(1))
-
-    # Extract the hostname and the reverse‑proxy settings
-    hostname: str | None = None
-    upstream_url: str | None = None
-    tls_trust_pool: str | None = None
-    trusted_proxies: List[str] | None = None
-
-    routes = server_cfg.get("routes", [])
-    for route in routes:
-        # hostname
-        if "match" in route and route["match"]:
-            host_list = route["match"][0].get("host", [])
-            if host_list:
-                hostname = host_list[0]
-
-        # reverse‑proxy sub‑route
-        handle = route.get("handle", [])
-        for h in handle:
-            if h.get("handler") == "subroute":
-                subroutes = h.get("routes", [])
-                for subroute in subroutes:
-                    for sh in subroute.get("handle", []):
-                        if sh.get("handler") == "reverse_proxy":
-                            # upstream dial address
-                            upstreams = sh.get("upstreams", [])
-                            if upstreams:
-                                upstream_url = upstreams[0].get("dial")
-
-                            # TLS configuration
-                            tls = sh.get("tls")
-                            if tls:
-                                tls_trust_pool = tls.get("cert_file")
-
-                            # Trusted proxies (if any)
-                            trusted_proxies = sh.get("trusted_proxies")
-                            if isinstance(trusted_proxies, list):
-                                # The Caddy API returns proxies as a list of str
-                                trusted_proxies = trusted_proxies
+    listen = server_cfg.get("listen")
+    m = _LISTEN_PORT_RE.search(listen[0]) if listen else None
+    port: int | None = int(m.group(1)) if m else None
+
+    # Each field comes from the first place it appears, so stop looking there
+    routes = server_cfg.get("routes") or []
+    hostname: str | None = next(
+        (
+            route["match"][0]["host"][0]
+            for route in routes
+            if route.get("match") and route["match"][0].get("host")
+        ),
+        None,
+    )
+    reverse_proxy = next(
+        (
+            sh
+            for route in routes
+            for h in route.get("handle", [])
+            if h.get("handler") == "subroute"
+            for subroute in h.get("routes", [])
+            for sh in subroute.get("handle", [])
+            if sh.get("handler") == "reverse_proxy"
+        ),
+        {},
+    )
+
+    upstreams = reverse_proxy.get("upstreams")
+    upstream_url: str | None = upstreams[0].get("dial") if upstreams else None
+    tls_trust_pool: str | None = (reverse_proxy.get("tls") or {}).get("cert_file")
+    # The Caddy API returns proxies as a list of str
+    trusted_proxies: List[str] | None = reverse_proxy.get("trusted_proxies")
 
     # Validation – ensure we have the minimal required data
     if not all([hostname, port, upstream_url]):
@@ -579,10 +692,7 @@ def load_caddy_server_to_object(server_name: str) -> int:
         upstream_url=upstream_url,
         tls_trust_pool=tls_trust_pool,
         trusted_proxies=trusted_proxies,
+        name=server_name,  # Preserve the original name reported by Caddy
     )
-    # Preserve the original name reported by Caddy
-    server_object.name = server_name
 
     return server_object
-
-init_db()
\ No newline at end of file
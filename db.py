@@ -0,0 +1,41 @@
+"""
+db.py
+Shared SQLite connection handling for the caddy and socat modules.
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# Database file path
+default_db_path = Path.home() / ".tailrelay.db"
+DB_PATH = os.getenv("DB_PATH", default_db_path)
+
+# One long-lived connection per thread instead of a connect() per query
+_local = threading.local()
+
+# Prepared statements are cached per connection, keyed by SQL text. With the
+# connection living as long as its thread, the db_* helpers only pay the
+# SQLite parse/plan cost the first time each query runs.
+STATEMENT_CACHE_SIZE = 128
+
+def get_db_connection() -> sqlite3.Connection:
+    """
+    Return this thread's database connection, opening it on first use.
+
+    The connection is kept for the lifetime of the thread, so callers must
+    not close it. WAL journaling lets readers proceed while a write is in
+    progress, and writers from other threads wait on the busy timeout
+    instead of failing with "database is locked".
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")  # 64 MB page cache
+        conn.execute("PRAGMA busy_timeout=10000")
+        _local.conn = conn
+    return conn
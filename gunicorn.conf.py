@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Every route blocks on I/O (Caddy admin API, socat spawn/stop, SQLite), so
+# serve them from a thread pool in a single worker process. One process keeps
+# the socat/Caddy bookkeeping in one place; the threads let slow admin calls
+# overlap instead of queueing behind each other.
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("THREADS", "16"))
@@ -9,52 +9,82 @@ import subprocess
 import logging
 import os
 import re
+import select
+import shutil
 import signal
 import sqlite3
-import psutil
+import threading
+import time
 from dataclasses import dataclass
-from pathlib import Path
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+from batch import run_batch
+from db import get_db_connection
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Database file path
-default_db_path = Path.home() / ".tailrelay.db"
-DB_PATH = os.getenv("DB_PATH", default_db_path)
+# Listening port in a raw socat command line (tcp-listen:<port>...)
+_LISTEN_RE = re.compile(rb"tcp-listen:(\d+)")
+
+# How long a process scan is reused before the process table is read again
+PROCESS_CACHE_TTL = 1.0
+_process_cache: Optional[Tuple[float, Dict[int, int]]] = None
 
 def get_socat_processes():
     """
     Finds all running `socat` processes and returns a mapping
     from listening port to the lowest PID that owns it.
 
+    The scan is cached for PROCESS_CACHE_TTL seconds so that status checks
+    made close together share one read of the process table.
+
     Returns:
         dict[int, int]: {port: pid}
     """
+    global _process_cache
+    cached = _process_cache
+    if cached and time.monotonic() - cached[0] < PROCESS_CACHE_TTL:
+        return cached[1]
+    port_to_pid = _scan_socat_processes()
+    _process_cache = (time.monotonic(), port_to_pid)
+    return port_to_pid
+
+def clear_process_cache() -> None:
+    """Forget the cached scan, e.g. after starting or stopping a relay."""
+    global _process_cache
+    _process_cache = None
+
+def _socat_listen_port(pid) -> Optional[int]:
+    """Return the port a socat process listens on, or None if `pid` isn't one."""
     try:
-        # Capture the output of `pgrep -a socat`
-        raw = subprocess.check_output(
-            ["pgrep", "-a", "socat"], text=True, stderr=subprocess.DEVNULL
-        )
-    except subprocess.CalledProcessError:
-        # No socat processes found
-        return {}
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        # The process exited (or never existed)
+        return None
+
+    # Arguments are NUL-separated; argv[0] is the program
+    program = cmdline.split(b"\0", 1)[0]
+    if os.path.basename(program) != b"socat":
+        return None
 
+    # Find the listening port in the command
+    match = _LISTEN_RE.search(cmdline)
+    return int(match.group(1)) if match else None
+
+def _scan_socat_processes():
+    """Walk /proc and map each socat listening port to its lowest PID."""
     port_to_pid = {}
-    for line in raw.strip().splitlines():
-        # Each line is: "<pid> <command>"
-        parts = line.split(maxsplit=1)
-        if len(parts) != 2:
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
             continue
-        pid_str, cmd = parts
-        pid = int(pid_str)
-
-        # Find the listening port in the command (tcp-listen:<port>...)
-        match = re.search(r"tcp-listen:(\d+)", cmd)
-        if not match:
+        port = _socat_listen_port(entry.name)
+        if port is None:
             continue
-        port = int(match.group(1))
+        pid = int(entry.name)
 
         # Keep the lowest PID for this port
         if port not in port_to_pid or pid < port_to_pid[port]:
@@ -62,66 +92,250 @@ def get_socat_processes():
 
     return port_to_pid
 
+@lru_cache(maxsize=1)
+def _socat_path() -> Optional[str]:
+    """Resolve the socat binary on PATH once, so spawns skip the PATH search."""
+    return shutil.which("socat")
+
+# Seconds a relay gets to exit after SIGTERM before it is sent SIGKILL
+STOP_GRACE_PERIOD = 10
+
+# socat processes started by this worker, keyed by what they forward. A
+# repeated start hands back the running process instead of spawning another.
+_PROXIES: Dict[Tuple[int, str, int], subprocess.Popen] = {}
+_PROXIES_LOCK = threading.Lock()
+
+def _reap_relays(signum=None, frame=None) -> None:
+    """
+    SIGCHLD handler: reap relays that exited on their own and drop them
+    from the registry.
+
+    Only registered processes are polled, never waitpid(-1), so other
+    children and their Popen objects are left alone. The handler runs on
+    the main thread between bytecodes, so it must not block on the lock;
+    if the lock is busy the sweep is skipped and the next signal or stop()
+    catches up.
+    """
+    if not _PROXIES_LOCK.acquire(blocking=False):
+        return
+    try:
+        for key, process in list(_PROXIES.items()):
+            if process.poll() is not None:
+                del _PROXIES[key]
+    finally:
+        _PROXIES_LOCK.release()
+    clear_process_cache()
+
+# SIGCHLD handler that was in place before install_reaper()
+_previous_sigchld = None
+
+def _on_sigchld(signum, frame) -> None:
+    """Reap our relays, then hand the signal on to the previous handler."""
+    _reap_relays()
+    if callable(_previous_sigchld):
+        _previous_sigchld(signum, frame)
+
+def install_reaper() -> bool:
+    """
+    Install the SIGCHLD handler that reaps relays which exit on their own.
+
+    Any handler already installed keeps running after ours. Signal
+    handlers can only be installed from the main thread; elsewhere this
+    does nothing. Calling it again is harmless.
+
+    Returns:
+        bool: True if the handler is installed.
+    """
+    global _previous_sigchld
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning("Not on the main thread, SIGCHLD reaper not installed")
+        return False
+    if signal.getsignal(signal.SIGCHLD) is not _on_sigchld:
+        _previous_sigchld = signal.signal(signal.SIGCHLD, _on_sigchld)
+    return True
+
+def _terminate_group(pid: int, pgid: Optional[int] = None) -> bool:
+    """
+    SIGTERM the process group of `pid` and wait for `pid` to exit, sending
+    SIGKILL after STOP_GRACE_PERIOD. Returns False if it was already gone.
+    """
+    # Pin the process with a pidfd so a recycled PID can't be
+    # mistaken for it while we wait
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        # It exited since we looked it up
+        clear_process_cache()
+        return False
+    try:
+        if pgid is None:
+            # Not necessarily a group leader (e.g. socat under timeout)
+            pgid = os.getpgid(pid)
+
+        # > Send a graceful SIGTERM
+        os.killpg(pgid, signal.SIGTERM)
+
+        # ~ Wait for it to exit; the pidfd turns readable when it
+        # does, so a prompt exit returns right away. poll() rather than
+        # select(), which can't take descriptors above FD_SETSIZE
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(STOP_GRACE_PERIOD * 1000):
+            # > Still running after the grace period, force it
+            logger.warning("socat relay ignored SIGTERM, sending SIGKILL")
+            os.killpg(pgid, signal.SIGKILL)
+            if not poller.poll(STOP_GRACE_PERIOD * 1000):
+                raise subprocess.TimeoutExpired("socat", 2 * STOP_GRACE_PERIOD)
+    finally:
+        os.close(pidfd)
+        clear_process_cache()
+    return True
+
+def _drain(pipe) -> str:
+    """Read whatever a relay's non-blocking pipe already holds, then close it."""
+    if pipe is None:
+        return ""
+    chunks = []
+    try:
+        while chunk := os.read(pipe.fileno(), 65536):
+            chunks.append(chunk)
+    except BlockingIOError:
+        # Nothing more buffered; don't wait for a writer that may linger
+        pass
+    finally:
+        pipe.close()
+    return b"".join(chunks).decode(errors="replace")
+
 @dataclass
 class SocatRelay:
     listening_port: int
     target_host: str
     target_port: int
     timeout: Optional[int] = None
+    # PID recorded in the database when the relay was started
+    recorded_pid: Optional[int] = None
+
+    @property
+    def key(self) -> Tuple[int, str, int]:
+        """The registry key for this relay's process."""
+        return (self.listening_port, self.target_host, self.target_port)
+
+    def start(self, capture_output: bool = False) -> subprocess.Popen:
+        """
+        Start socat for this relay, or return the process already serving it.
+
+        socat's output is discarded unless `capture_output` is set. Nothing
+        reads a relay's pipes while it runs, so a chatty socat would
+        eventually block writing to a full one.
+        """
+        with _PROXIES_LOCK:
+            process = self._start_locked(capture_output)
+        clear_process_cache()
+        return process
+
+    def _start_locked(self, capture_output: bool) -> subprocess.Popen:
+        """Body of start(); the caller holds _PROXIES_LOCK."""
+        process = _PROXIES.get(self.key)
+        if process is not None and process.poll() is None:
+            logger.info("socat relay on port %d is already running", self.listening_port)
+            self.recorded_pid = process.pid
+            return process
+
+        socat_path = _socat_path()
+        if socat_path is None:
+            # Don't cache the miss; socat may be installed later
+            _socat_path.cache_clear()
+            raise subprocess.SubprocessError("socat is not installed or not in PATH")
 
-    def start(self) -> subprocess.Popen:
         # Build the socat command
         cmd = [
-            'socat',
+            socat_path,
             f'tcp-listen:{self.listening_port},fork,reuseaddr',
             f'tcp:{self.target_host}:{self.target_port}'
         ]
         
-        # Add timeout if specified
+        # Bound the relay's lifetime with timeout(1) if specified; it
+        # escalates to SIGKILL itself if socat ignores the SIGTERM
         if self.timeout:
-            cmd.extend(['timeout', str(self.timeout)])
+            cmd = ['timeout', '--kill-after=2', str(self.timeout)] + cmd
         
         try:
             # Start the socat process
+            output = subprocess.PIPE if capture_output else subprocess.DEVNULL
             process = subprocess.Popen(
                 cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                preexec_fn=os.setsid  # Create new process group
+                stdout=output,
+                stderr=output,
+                text=capture_output,
+                # New session (and process group) without a Python
+                # callback between fork and exec
+                start_new_session=True,
             )
-            
-            logger.info(f"Started socat relay on port {self.listening_port} "
-                    f"forwarding to {self.target_host}:{self.target_port}")
-            
-            return process
-            
         except FileNotFoundError:
+            # socat (or timeout) disappeared since the PATH lookup; any
+            # other OSError from the spawn propagates as is
+            _socat_path.cache_clear()
             raise subprocess.SubprocessError("socat is not installed or not in PATH")
-        except Exception as e:
-            raise subprocess.SubprocessError(f"Failed to start socat: {str(e)}")
 
-    def stop(self) -> Tuple[int, str, str]:
-        if self.pid:
-            proc = psutil.Process(self.pid)
+        if capture_output:
+            # stop() only collects what is already buffered
+            os.set_blocking(process.stdout.fileno(), False)
+            os.set_blocking(process.stderr.fileno(), False)
+
+        _PROXIES[self.key] = process
+        self.recorded_pid = process.pid
+        logger.info("Started socat relay on port %d forwarding to %s:%d",
+            self.listening_port, self.target_host, self.target_port)
+        
+        return process
 
-            # ? Query its status
-            # print(proc.status())          # 'running', 'sleeping', 'zombie', …
-            # print(proc.create_time())     # epoch timestamp
-            # print(proc.cpu_times())       # user + system time
+    def stop(self) -> Tuple[Optional[int], str, str]:
+        """
+        Stop the relay's process group, escalating to SIGKILL if it
+        outlives STOP_GRACE_PERIOD.
 
-            # > Send a graceful SIGTERM
-            os.killpg(os.getpgid(self.pid), signal.SIGTERM)
+        Returns:
+            tuple: (returncode, stdout, stderr). The return code is only
+            known for a process this worker started, and output only if it
+            was started with capture_output; otherwise None and "".
+        """
+        with _PROXIES_LOCK:
+            process = _PROXIES.pop(self.key, None)
+        if process is not None and process.poll() is None:
+            # Our own child was started in a new session, so it leads its
+            # process group and can't be reaped from under us
+            pid = pgid = process.pid
+        else:
+            pid = self.pid
+            pgid = None
 
-            # ~ Wait for it to exit
-            proc.wait(timeout=10)         # raises psutil.TimeoutExpired if still running
+        if pid and _terminate_group(pid, pgid):
             logger.info("Stopped socat relay")
         else:
             logger.info("socat relay is not running!")
 
+        if process is None:
+            return None, "", ""
+        # Reap our own child so it doesn't linger as a zombie, then collect
+        # what it left in its pipes without waiting for more
+        return process.poll(), _drain(process.stdout), _drain(process.stderr)
+
     @property
     def pid(self) -> Optional[int]:
-        """Return a mapping of listening ports to the lowest PID."""
+        """
+        Return the PID of the socat process serving this relay, if any.
+
+        A process this worker started is known without touching /proc. Next
+        comes the recorded PID, which costs one read of its /proc entry; the
+        cmdline must still be a socat on our port, so a recycled PID is not
+        mistaken for the relay. Relays started outside this app (or before
+        the PID was recorded) fall back to a scan.
+        """
+        process = _PROXIES.get(self.key)
+        if process is not None and process.poll() is None:
+            return process.pid
+        if self.recorded_pid and _socat_listen_port(self.recorded_pid) == self.listening_port:
+            return self.recorded_pid
         return get_socat_processes().get(self.listening_port)
 
     @property
@@ -137,10 +351,38 @@ class SocatRelay:
             raise ValueError("Status can only be set to 'stopped' or 'running'")
         self._attribute = value
 
+def start_socat_relays(relays: List[SocatRelay], capture_output: bool = False) -> List[subprocess.Popen]:
+    """
+    Start several relays back to back and return their processes.
+
+    The registry lock is taken once for the whole batch and the process
+    cache is cleared once at the end. If a spawn fails, the relays started
+    before it stay running (and registered) and the error is raised.
+    """
+    try:
+        with _PROXIES_LOCK:
+            return [relay._start_locked(capture_output) for relay in relays]
+    finally:
+        clear_process_cache()
+
+def stop_socat_relays(relays: List[SocatRelay]) -> Dict[int, Union[Tuple, Exception]]:
+    """
+    Stop several relays concurrently.
+
+    Each relay's grace period runs in parallel with the others instead of
+    back to back. A failure for one relay doesn't stop the rest.
+
+    Returns:
+        dict: Each listening port mapped to what stop() returned, or to the
+        exception it raised.
+    """
+    return run_batch(SocatRelay.stop, relays, key=lambda relay: relay.listening_port)
+
 def init_db():
     """Initialize the SQLite database for process tracking."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        conn = get_db_connection()
+        with conn:
             cursor = conn.cursor()
             
             # Create table for proxy processes
@@ -150,22 +392,22 @@ def init_db():
                     listening_port INTEGER NOT NULL UNIQUE,
                     target_host TEXT NOT NULL,
                     target_port INTEGER NOT NULL,
-                    status TEXT DEFAULT stopped,
+                    status TEXT DEFAULT 'stopped',
+                    pid INTEGER,
                     create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            
+
+            # Databases created before the pid column existed
+            columns = {row["name"] for row in cursor.execute("PRAGMA table_info(socat_relays)")}
+            if "pid" not in columns:
+                cursor.execute("ALTER TABLE socat_relays ADD COLUMN pid INTEGER")
+
     except sqlite3.Error as e:
         print(f"Database initialization failed: {e}")
 
-def get_db_connection():
-    """Create and return a database connection."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
 def db_insert_socat_relay(socat_relay:SocatRelay):
-    """Insert a new socat relay into the database."""
+    """Insert a new socat relay into the database and return the new row."""
     listening_port = socat_relay.listening_port
     target_host = socat_relay.target_host
     target_port = socat_relay.target_port
@@ -173,21 +415,21 @@ def db_insert_socat_relay(socat_relay:SocatRelay):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        INSERT INTO socat_relays 
-        (listening_port, target_host, target_port)
-        VALUES (?, ?, ?)
-    ''', (
-        listening_port,
-        target_host,
-        target_port
-    ))
+    # Roll back on a UNIQUE violation so the shared connection isn't left
+    # holding an open write transaction
+    with conn:
+        relay = cursor.execute('''
+            INSERT INTO socat_relays 
+            (listening_port, target_host, target_port)
+            VALUES (?, ?, ?)
+            RETURNING *
+        ''', (
+            listening_port,
+            target_host,
+            target_port
+        )).fetchone()
     
-    id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return id
+    return dict(relay)
 
 def db_get_socat_relay(id):
     """Retrieve socat relay db entry by id."""
@@ -197,7 +439,6 @@ def db_get_socat_relay(id):
         'SELECT * FROM socat_relays WHERE id = ?', 
         (id,)
     ).fetchone()
-    conn.close()
     return dict(relay)
 
 def db_list_socat_relays():
@@ -205,41 +446,71 @@ def db_list_socat_relays():
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    relays = cursor.execute('SELECT * FROM socat_relays').fetchall()
-    conn.close()
+    relays = cursor.execute('SELECT * FROM socat_relays')
     
+    # Build the dicts straight off the cursor rather than from a fetchall() copy
     return [dict(row) for row in relays]
 
+def list_socat_relays(running=None):
+    """
+    Retrieve all socat relays with their live status.
+
+    The process table is scanned once for the whole list instead of once
+    per relay. Callers that already hold a get_socat_processes() result
+    can pass it as `running`.
+    """
+    if running is None:
+        running = get_socat_processes()
+    relays = db_list_socat_relays()
+    for relay in relays:
+        relay["status"] = "running" if relay["listening_port"] in running else "stopped"
+    return relays
+
 def db_delete_socat_selay(id):
     """Delete a socat relay from the database."""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM socat_relays WHERE id = ?', (id,))
     conn.commit()
-    conn.close()
 
-def db_update_socat_relay(relay:SocatRelay, relay_id:int) -> None:
+def db_update_socat_relay(relay:SocatRelay, relay_id:int) -> Optional[dict]:
     """
-    Updates an existing server record based on its name.
+    Updates an existing relay record based on its id and returns the
+    updated row, or None if not found.
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        UPDATE socat_relays
-        SET listening_port = ?, target_host = ?, target_port = ?, status = ?
-        WHERE id = ?
-        """,
-        (
-            relay.listening_port,
-            relay.target_host,
-            relay.target_port,
-            relay.status,
-            relay_id,
-        ),
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        row = cursor.execute(
+            """
+            UPDATE socat_relays
+            SET listening_port = ?, target_host = ?, target_port = ?, status = ?
+            WHERE id = ?
+            RETURNING *
+            """,
+            (
+                relay.listening_port,
+                relay.target_host,
+                relay.target_port,
+                relay.status,
+                relay_id,
+            ),
+        ).fetchone()
+    return dict(row) if row else None
+
+def db_update_socat_relay_status(relay_id:int, status:str, pid:Optional[int] = None) -> Optional[dict]:
+    """
+    Updates only the status and pid columns of a relay record and returns
+    the updated row, or None if not found. A stopped relay has no pid.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    with conn:
+        row = cursor.execute(
+            "UPDATE socat_relays SET status = ?, pid = ? WHERE id = ? RETURNING *",
+            (status, pid, relay_id),
+        ).fetchone()
+    return dict(row) if row else None
 
 def socat_relay_from_db(relay_id: int) -> Optional[SocatRelay]:
     """
@@ -254,7 +525,6 @@ def socat_relay_from_db(relay_id: int) -> Optional[SocatRelay]:
         listening_port=row["listening_port"],
         target_host=row["target_host"],
         target_port=row["target_port"],
-        timeout=None  # you could store timeout in the DB as well
+        timeout=None,  # you could store timeout in the DB as well
+        recorded_pid=row["pid"],
     )
-
-init_db()
\ No newline at end of file